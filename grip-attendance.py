@@ -29,10 +29,9 @@ __version__ = "0.01"
 
 import sys
 import os
-import csv
-import configparser
-import re
-from functools import reduce
+# csv and configparser are imported where they're used, so the help/usage
+# paths, which need neither, skip their import time. A normal run still
+# imports both (and re through them), so its start up time is unchanged.
 
 
 # MODULE GLOBALS
@@ -42,6 +41,27 @@ NOTE_LABEL = "NOTE:  "
 DEFAULT_CFG_PATH = os.path.normpath("./attendance.cfg")
 # appended to the registration file path to receive the script's output
 OUTPUT_APPEND = "_attendance.csv"
+# size, in bytes, of the write buffer used for the attendance file
+WRITE_BUFFER_SIZE = 1 << 20
+# environment variable used to select the log level, and the available levels
+LOG_ENV_VAR = "GRIP_ATTENDANCE_LOG"
+LOG_LEVELS = {"ERROR":40
+              ,"WARNING":30
+              ,"INFO":20
+              ,"DEBUG":10
+              }
+DEFAULT_LOG_LEVEL = "INFO"
+# maximum number of records displayed for any single event, further records
+# are only counted and reported in the summary
+LOG_MAX_RECORDS = 20
+# log state: the active level (resolved on first use), along with the number
+# of records logged, displayed, and held back by LOG_MAX_RECORDS, for each
+# event
+_log_state = {"level":None
+              ,"logged":{}
+              ,"shown":{}
+              ,"capped":{}
+              }
 
 
 def open_file(pathname, mode='r', newline=None, verbose=True):
@@ -70,6 +90,72 @@ def open_file(pathname, mode='r', newline=None, verbose=True):
         return fp
 
 
+def log_level():
+    """Resolves the active log level from the LOG_ENV_VAR environment
+    variable the first time it's needed. Unrecognized values fall back to
+    DEFAULT_LOG_LEVEL.
+
+    Returns:
+        The numeric value of the active log level
+    """
+    if _log_state['level'] is None:
+        name = os.environ.get(LOG_ENV_VAR, DEFAULT_LOG_LEVEL).upper()
+        if name not in LOG_LEVELS:
+            fmt = "{0}Unrecognized {1} value: '{2}', using {3}"
+            print(fmt.format(ERR_LABEL, LOG_ENV_VAR, name, DEFAULT_LOG_LEVEL)
+                  ,file=sys.stderr)
+            name = DEFAULT_LOG_LEVEL
+        _log_state['level'] = LOG_LEVELS[name]
+    return _log_state['level']
+
+
+def log_event(level, event, **fields):
+    """Writes a structured (key=value) log record to stderr, if the level is
+    enabled. Every record is counted, but at most LOG_MAX_RECORDS records
+    are displayed for each event, the rest are reported by log_summary().
+
+    Args:
+        level - string naming the record's level, a key in LOG_LEVELS
+        event - string identifying the kind of event being logged
+        fields - keyword arguments containing the record's data
+    Returns:
+        No returned value
+    """
+    logged = _log_state['logged']
+    logged[event] = logged.get(event, 0) + 1
+    if LOG_LEVELS[level] < log_level():
+        return
+    shown = _log_state['shown']
+    if shown.get(event, 0) >= LOG_MAX_RECORDS:
+        capped = _log_state['capped']
+        capped[event] = capped.get(event, 0) + 1
+        return
+    shown[event] = shown.get(event, 0) + 1
+    items = ["level={0}".format(level), "event={0}".format(event)]
+    items.extend("{0}={1!r}".format(k, v) for k, v in sorted(fields.items()))
+    print(' '.join(items), file=sys.stderr)
+
+
+def log_summary():
+    """Writes an INFO level summary record for each event that has been
+    logged, with the total number of records and, if the event's level was
+    enabled but some records weren't displayed because of LOG_MAX_RECORDS,
+    the number held back.
+
+    Returns:
+        No returned value
+    """
+    if LOG_LEVELS['INFO'] < log_level():
+        return
+    for event, count in sorted(_log_state['logged'].items()):
+        capped = _log_state['capped'].get(event, 0)
+        fmt = "level=INFO event=summary name={0} count={1}"
+        line = fmt.format(event, count)
+        if capped:
+            line += " over_max_records={0}".format(capped)
+        print(line, file=sys.stderr)
+
+
 def config_help():
     """Help string for the configuration file.
     Returns:
@@ -131,6 +217,7 @@ def default_config():
     Returns:
         A ConfigParser object with module defaults set
     """
+    import configparser
     cfg = configparser.ConfigParser()
     cfg['DEFAULT'] = {"EMAIL_FIELD":"Email"
                       ,"FIRST_NM_FIELD":"First Name"
@@ -150,8 +237,10 @@ def wrap_and_indent(text, width, indent):
     """A word-wrap function that preserves existing line breaks
     and most spaces in the text. Expects that existing line
     breaks are posix newlines (\n).
-    Borrowed directly from:
+    Based on the reduce() one-liner from:
         http://code.activestate.com/recipes/148061-one-liner-word-wrap-function/
+    but collects the pieces in a list and joins them once, tracking the
+    current column instead of re-scanning the growing string for each word.
     
     Args:
         text - string containing the text to be wrapped and indented
@@ -160,17 +249,23 @@ def wrap_and_indent(text, width, indent):
     Returns:
         A string ready for printing
     """
-    wrapped = reduce(lambda line, word, width=width: '%s%s%s' %
-                  (line,
-                   ' \n'[(len(line)-line.rfind('\n')-1
-                         + len(word.split('\n',1)[0]
-                              ) >= width)],
-                   word),
-                  text.split(' ')
-                 )
-    pattern = re.compile('\\n', re.MULTILINE)
-    indent_fmt = "{0}" + re.sub(pattern, "\n{0}", wrapped)
-    return indent_fmt.format(' '*indent)
+    words = text.split(' ')
+    pieces = [words[0]]
+    col = len(words[0]) - words[0].rfind('\n') - 1
+    for word in words[1:]:
+        nl = word.find('\n')
+        head_len = len(word) if nl == -1 else nl
+        if col + head_len >= width:
+            pieces.append('\n')
+            col = 0
+        else:
+            pieces.append(' ')
+            col += 1
+        pieces.append(word)
+        nl = word.rfind('\n')
+        col = col + len(word) if nl == -1 else len(word) - nl - 1
+    pad = ' '*indent
+    return pad + ''.join(pieces).replace('\n', '\n' + pad)
 
 
 def usage_message(program_file):
@@ -212,8 +307,17 @@ def usage_message(program_file):
            "\"en\" accompanied by a mandatory pathname (-gen config-path.cfg) "
            "will cause the program to generate a template config file that "
            "you can customize for your registration and attendee list formats."
+           "\n\n"
+           "By default, only summary counts are reported. Setting the "
+           "{1} environment variable to DEBUG also logs each unregistered "
+           "attendee (at most {2} records, the rest are only counted), "
+           "while WARNING or ERROR "
+           "suppresses the summary."
            )
-    explanation = wrap_and_indent(txt.format(DEFAULT_CFG_PATH), 72, 8)
+    explanation = wrap_and_indent(txt.format(DEFAULT_CFG_PATH
+                                             ,LOG_ENV_VAR
+                                             ,LOG_MAX_RECORDS)
+                                  ,72, 8)
     config_txt = wrap_and_indent(config_help(), 72, 8)
     return usage, explanation, config_txt
 
@@ -269,8 +373,7 @@ def gen_config_template(config_path):
         with cfg_file:
             # Dump out the comments / instructions
             config_txt = wrap_and_indent(config_help(), 72, 1)
-            np = re.compile('\\n', re.MULTILINE)
-            config_text_comments = re.sub(np, "\n#", "#" + config_txt)
+            config_text_comments = "#" + config_txt.replace("\n", "\n#")
             cfg_file.write(config_text_comments)
             # Get a default config object & initialize the list of 
             # values
@@ -360,7 +463,7 @@ def proc_args(program_file, argv):
     Returns:
         Argument dictionary with {"registrations":file_object
                                   ,"attendees":file_object
-                                  ,"attendance":file_object
+                                  ,"attendance":pathname
                                   ,"config":config_object
                                   }
         ... if the argument list parsed correctly.
@@ -399,9 +502,17 @@ def proc_args(program_file, argv):
     elif len(argv) == 3 or len(argv) == 4:
         regf = open_file(argv[1])
         attf = open_file(argv[2])
-        outf = open_file(os.path.splitext(argv[1])[0] + OUTPUT_APPEND
-                         ,mode='w'
-                         ,newline='')
+        # The attendance file isn't opened until it's written (see
+        # gen_attendance()), but we can still check that we'll be able to
+        # replace it: an existing file must be writable, as it would be for
+        # open(..., 'w'), and its directory (following any symlink) must
+        # allow the temporary file to be created.
+        outf = os.path.splitext(argv[1])[0] + OUTPUT_APPEND
+        out_real = os.path.realpath(outf)
+        if (not os.access(os.path.dirname(out_real), os.W_OK) or
+           (os.path.exists(out_real) and not os.access(out_real, os.W_OK))):
+            print("Sorry, you don't have access to '{0}'".format(outf))
+            outf = None
         if regf is not None and attf is not None and outf is not None:
             args['registrants'] = regf
             args['attendees'] = attf
@@ -435,6 +546,7 @@ def proc_registration(reg_file, config):
         - A list of the registrants
         - A list containing the fieldnames in the registration list data
     """
+    import csv
     reg_list = []
     attended_field = config['REGISTRANTS']['ATTENDED_FIELD']
     attend_duration_field = config['REGISTRANTS']['ATTEND_DUR_FIELD']
@@ -468,7 +580,7 @@ def proc_attendees(att_file, config):
         dictionary containing the de-duplicated collection of all attendees.
         Keys are the email attendee email addresses forced to lower case.
     """
-    
+    import csv
     attendees = {}
     email_field = config['ATTENDEES']['EMAIL_FIELD']
     with att_file:
@@ -542,7 +654,8 @@ def check_attendance(registrants, attendees, config):
         new_reg[attend_dur_reg] = unregistered[attend_dur_att]
         new_reg[attended_field] = True        
         registrants.append(new_reg)
-        print("Unregistered attendee: " + repr(unregistered[email_field_att]))
+        log_event('DEBUG', 'unregistered_attendee'
+                  ,email=unregistered[email_field_att])
 
     # Keeps the counts of registrants, attendees, etc.
     counts = {'registrants':len(registrants)
@@ -599,15 +712,21 @@ def format_counts(counts):
                        ,counts['attend_no_reg'])
 
 
-def gen_attendance(out_file, registrants, fields, config):
-    """Open/Create the CSV file to receive the new attendance information and
+def gen_attendance(out_path, registrants, fields, config):
+    """Create the CSV file to receive the new attendance information and
     write the records.  Note that the ATTENDED_FIELD column is added to the
     list of field names by this function.
 
+    The records are written, through a WRITE_BUFFER_SIZE buffer, to a
+    temporary file in the same directory as out_path, which then replaces
+    out_path. An interrupted run never leaves a partially written
+    attendance file behind. If out_path is a symlink, the file it points to
+    is the one replaced. An existing file's permissions are kept, but its
+    ownership is not, the new file belongs to the user running the script.
+
     Args:
-        out_file - file object for the file that will  contain the updated
+        out_path - pathname of the file that will contain the updated
                     registration / attendance records
-                    We assume that this file object is valid, so no checking
         registrants - list of the updated registration / attendance records
         fields - list of the fields, in the desired order, to be written
         config - ConfigParser object containing the configuration data
@@ -615,15 +734,43 @@ def gen_attendance(out_file, registrants, fields, config):
     Returns:
        No returned value
     """
+    import csv
     # We added new columns to the CSV file
     fields.extend([config['REGISTRANTS']['ATTENDED_FIELD']
                    ,config['REGISTRANTS']['ATTEND_DUR_FIELD']])
-    with out_file:
-        writer = csv.DictWriter(out_file, fields)
-        writer.writeheader()
-        for reg in registrants:
-            # print(reg)
-            writer.writerow(reg)
+    # Replace the target of a symlink, rather than the link itself
+    out_path = os.path.realpath(out_path)
+    tmp_path = out_path + '.{0}.tmp'.format(os.getpid())
+    # A hard-killed run with the same (reused) pid may have left this behind
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+    # Created with the same umask derived permissions as a plain open()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    out_file = None
+    try:
+        out_file = open(fd, 'w', newline='', buffering=WRITE_BUFFER_SIZE)
+        with out_file:
+            writer = csv.DictWriter(out_file, fields)
+            writer.writeheader()
+            writer.writerows(registrants)
+            # Get the data onto the disk before the rename, so that a crash
+            # can't leave an empty or truncated attendance file in place
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        # Keep the permissions of the file we're replacing
+        try:
+            os.chmod(tmp_path, os.stat(out_path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        # Once wrapped, the file object owns (and has closed) the descriptor
+        if out_file is None:
+            os.close(fd)
+        os.remove(tmp_path)
+        raise
             
 
 def match_main(arg_dict):
@@ -635,7 +782,8 @@ def match_main(arg_dict):
     
     Args:
         arg_dict - dictionary containing the file objects for the registration
-                    and attendee lists, along with the config object
+                    and attendee lists, the attendance file pathname, along
+                    with the config object
     Returns:
         Nothing
     """
@@ -645,7 +793,9 @@ def match_main(arg_dict):
     attendees = proc_attendees(arg_dict['attendees'], cfg)
     attendance = check_attendance(registrants, attendees, cfg)
     gen_attendance(arg_dict['attendance'], registrants, fields, cfg)
+    print("Wrote: '{0}'".format(arg_dict['attendance']))
     print(format_counts(attendance))
+    log_summary()
 
 
 if __name__ == '__main__':